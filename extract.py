@@ -1,9 +1,15 @@
 import duckdb
 import pandas as pd
+import pyarrow.compute as pc
 from typing import Optional, List
 
+
+def _quote_literal(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
 def extract_sensor_data(
-    db_path: str,
+    con: duckdb.DuckDBPyConnection,
     plant_code: str,
     machine_code: str,
     start_time: Optional[str] = None,
@@ -12,26 +18,30 @@ def extract_sensor_data(
     sensor_names: Optional[List[str]] = None,
     limit: int = 1000
 ) -> pd.DataFrame:
-    con = duckdb.connect(db_path)
-
-    # 基本クエリ（センサーデータ + イベントJOIN）
+    # 基本クエリ（工場・機械番号はsensor_dataの列で絞り込む）
     query = """
         SELECT
             s.timestamp,
             s.parameter_id,
             s.parameter_name,
             s.unit,
-            TRY_CAST(s.value AS DOUBLE) AS value_numeric
+            s.value::DOUBLE AS value_numeric
         FROM sensor_data s
-        LEFT JOIN processed_file_periods p
-        ON s.source_file = p.source_file
         WHERE s.plant_code = ? AND s.machine_no_from_file = ?
     """
 
     params = [plant_code, machine_code]
 
+    # イベントは処理済み記録の (source_file, event, 期間) を対応表として絞り込む
     if event:
-        query += " AND p.event = ?"
+        query += """
+            AND EXISTS (
+                SELECT 1 FROM processed_file_periods p
+                WHERE p.source_file = s.source_file
+                AND p.event = ?
+                AND s.timestamp BETWEEN p.start_time AND p.end_time
+            )
+        """
         params.append(event)
 
     if start_time:
@@ -47,21 +57,46 @@ def extract_sensor_data(
         query += f" AND s.parameter_name IN ({placeholders})"
         params.extend(sensor_names)
 
-    query += " ORDER BY s.timestamp LIMIT ?"
+    # メタ情報とPIVOTで同じ行集合を得るため、LIMIT境界の並びを一意にする
+    query += " ORDER BY s.timestamp, s.parameter_id LIMIT ?"
     params.append(limit)
 
-    df = con.execute(query, params).df()
-    con.close()
+    # IDと単位の一覧（センサーマスタ情報として別途抽出）
+    meta_tbl = con.execute(
+        f"""
+        SELECT DISTINCT parameter_name, parameter_id, unit
+        FROM ({query})
+        ORDER BY parameter_name
+        """,
+        params,
+    ).to_arrow_table()
 
-    # 横持ち形式に変換（timestampごとにpivot）
-    if not df.empty:
-        pivot_df = df.pivot(index="timestamp", columns="parameter_name", values="value_numeric")
-        pivot_df.reset_index(inplace=True)
+    # 該当行なし、またはセンサー名がすべてNULLの場合はPIVOTの列挙値が空になる
+    names = pc.unique(meta_tbl["parameter_name"].drop_null()).to_pylist()
+    if not names:
+        return pd.DataFrame(
+            columns=["timestamp", "parameter_id", "parameter_name", "unit", "value_numeric"]
+        )
 
-        # IDと単位の一覧（センサーマスタ情報として別途抽出）
-        meta_df = df[["parameter_name", "parameter_id", "unit"]].drop_duplicates().sort_values("parameter_name")
-        pivot_df.attrs["sensor_metadata"] = meta_df
+    # 横持ち形式に変換（timestampごとにDuckDBのPIVOTで集約）
+    # パラメータ付きのPIVOTは列挙値の明示が必要なため、メタ情報のセンサー名を使う
+    pivot_names = ", ".join(_quote_literal(name) for name in names)
+    pivot_query = f"""
+        PIVOT (
+            SELECT timestamp, parameter_name, value_numeric FROM ({query})
+        )
+        ON parameter_name IN ({pivot_names})
+        USING first(value_numeric)
+        GROUP BY timestamp
+        ORDER BY timestamp
+    """
+    # 結果はArrowで受け取り、戻り値のpandas変換は最後の1回だけ行う
+    pivot_tbl = con.execute(pivot_query, params).to_arrow_table()
 
-        return pivot_df
+    # 列ごとに独立した配列のまま変換し（2次元ブロックへの統合コピーをしない）、
+    # 変換済みのArrowバッファは順次解放してピークメモリを抑える
+    pivot_df = pivot_tbl.to_pandas(split_blocks=True, self_destruct=True)
+    del pivot_tbl
+    pivot_df.attrs["sensor_metadata"] = meta_tbl.to_pandas()
 
-    return df
+    return pivot_df
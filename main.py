@@ -1,16 +1,43 @@
-import io
+import csv
+import multiprocessing as mp
+import os
 import re
 import zipfile
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set, Tuple
 
 import duckdb
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from pydantic import BaseModel, ValidationError
 from tqdm import tqdm
 
+# センサーファイル名: <工場コード>#<機械番号><ddmmyy><HHMMSS>_<センサー種別>
+_FILENAME_RE = re.compile(
+    r"(?P<plant_code>[A-Z]+)#(?P<machine_code>\d+)(?P<datestr>\d{6})(?P<timestr>\d{6})_(?P<sensor_type>[^.]+)"
+)
+
+# CSVの時刻列で想定する書式（先頭の値で判定し、該当なしはpandasの推定に任せる）
+_TIMESTAMP_FORMATS = (
+    "%Y/%m/%d %H:%M:%S",
+    "%Y/%m/%d %H:%M:%S.%f",
+    "%Y/%m/%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+)
+
+# 行末のカンマ（ヘッダー行のデコード前のバイト列に適用する）
+_TRAILING_COMMAS_RE = re.compile(rb",+(?=\r?$)", re.MULTILINE)
+
+# 縦持ち変換用のインメモリDuckDB（プロセスごとに1本、初回利用時に作成）
+_LOCAL_CON: Optional[duckdb.DuckDBPyConnection] = None
+
 
 def json_serial(obj):
     if isinstance(obj, datetime):
@@ -60,8 +87,7 @@ class GroupedSensorFileSet(BaseModel):
     files: List[FileMetadata]
 
 
-def init_processed_file_periods_table(db_path: str):
-    con = duckdb.connect(db_path)
+def init_processed_file_periods_table(con: duckdb.DuckDBPyConnection):
     con.execute("""
         CREATE TABLE IF NOT EXISTS processed_file_periods (
             source_file TEXT,
@@ -72,57 +98,74 @@ def init_processed_file_periods_table(db_path: str):
             PRIMARY KEY (source_file, event)
         )
     """)
-    con.close()
 
 
-def is_file_event_already_processed(
-    db_path: str,
-    source_file: str,
-    event: str,
-    event_start: datetime,
-    event_end: datetime,
-) -> bool:
-    con = duckdb.connect(db_path)
-    result = con.execute(
-        """
-        SELECT 1 FROM processed_file_periods
-        WHERE source_file = ? AND event = ?
-        AND start_time <= ? AND end_time >= ?
-    """,
-        (source_file, event, event_start, event_end),
-    ).fetchone()
-    con.close()
-    return result is not None
+# --- イベント期間全体が処理済みの (source_file, event) を1クエリで取得 ---
+def fetch_processed_file_events(
+    con: duckdb.DuckDBPyConnection,
+    candidates: pd.DataFrame,
+) -> Set[Tuple[str, str]]:
+    if candidates.empty:
+        return set()
+
+    con.register("candidates", candidates)
+    rows = con.execute("""
+        SELECT c.source_file, c.event
+        FROM candidates c
+        JOIN processed_file_periods p USING (source_file, event)
+        WHERE p.start_time <= c.event_start AND p.end_time >= c.event_end
+    """).fetchall()
+    con.unregister("candidates")
+    return set(rows)
 
 
 def mark_file_event_as_processed(
-    db_path: str,
+    con: duckdb.DuckDBPyConnection,
     source_file: str,
     source_zip: Optional[str],
     event: str,
     start_time: datetime,
     end_time: datetime,
 ):
-    con = duckdb.connect(db_path)
-    con.execute(
-        """
+    mark_file_events_as_processed(
+        con, [(source_file, source_zip, event, start_time, end_time)]
+    )
+
+
+# --- (source_file, source_zip, event, start_time, end_time) をまとめて処理済み記録 ---
+def mark_file_events_as_processed(
+    con: duckdb.DuckDBPyConnection,
+    rows: List[Tuple[str, Optional[str], str, datetime, datetime]],
+):
+    if not rows:
+        return
+
+    marks = pd.DataFrame(
+        rows, columns=["source_file", "source_zip", "event", "start_time", "end_time"]
+    )
+    con.register("marks", marks)
+    con.execute("""
         INSERT INTO processed_file_periods
         (source_file, source_zip, event, start_time, end_time)
-        VALUES (?, ?, ?, ?, ?)
+        SELECT
+            source_file,
+            arg_max(source_zip, end_time),
+            event,
+            arg_max(start_time, end_time),
+            max(end_time)
+        FROM marks
+        GROUP BY source_file, event
         ON CONFLICT (source_file, event) DO UPDATE
         SET start_time = excluded.start_time,
             end_time = excluded.end_time
         WHERE excluded.end_time > processed_file_periods.end_time
-    """,
-        (source_file, source_zip, event, start_time, end_time),
-    )
-    con.close()
+    """)
+    con.unregister("marks")
 
 
 # --- ファイル名からメタ情報を抽出 ---
 def extract_metadata_from_filename(file: Path) -> Optional[FileMetadata]:
-    pattern = r"(?P<plant_code>[A-Z]+)#(?P<machine_code>\d+)(?P<datestr>\d{6})(?P<timestr>\d{6})_(?P<sensor_type>[^.]+)"
-    match = re.match(pattern, file.name)
+    match = _FILENAME_RE.match(file.name)
     if not match:
         return None
 
@@ -138,7 +181,7 @@ def extract_metadata_from_filename(file: Path) -> Optional[FileMetadata]:
     end_time = min(max_end_time, file_mtime) if file_mtime else max_end_time
 
     return FileMetadata(
-        plant_code= match.group("plant_code"),
+        plant_name_from_file= match.group("plant_code"),
         machine_no_from_file= match.group("machine_code"),
         sensor_type= match.group("sensor_type"),
         start_time= dt,
@@ -148,23 +191,42 @@ def extract_metadata_from_filename(file: Path) -> Optional[FileMetadata]:
     
 
 
+# --- フォルダ配下のファイルを再帰的に列挙（ディレクトリの種別判定はscandirの結果を使う） ---
+def iter_file_entries(root) -> Iterator[os.DirEntry]:
+    try:
+        it = os.scandir(root)
+    except OSError:
+        # os.walk と同様、開けないディレクトリは読み飛ばす
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_file_entries(entry.path)
+            elif entry.is_file():
+                yield entry
+
+
 # --- 指定フォルダからファイルを収集 ---
 def collect_sensor_files(target_folder, name_patterns) -> List[FileMetadata]:
-    all_files = list(Path(target_folder).rglob("*"))
     collected = []
+    scanned = 0
 
-    tqdm.write(f"🔍 検索対象ファイル数: {len(all_files)}")
     tqdm.write(f"📂 name_patterns: {name_patterns}")
 
-    for file in all_files:
-        if file.suffix.lower() == ".csv":
-            if any(pat in file.name for pat in name_patterns):
-                tqdm.write(f"✅ マッチ: {file.name}")
-                metadata = extract_metadata_from_filename(file)
+    for entry in iter_file_entries(target_folder):
+        scanned += 1
+        name = entry.name
+        suffix = os.path.splitext(name)[1].lower()
+
+        if suffix == ".csv":
+            if any(pat in name for pat in name_patterns):
+                tqdm.write(f"✅ マッチ: {name}")
+                metadata = extract_metadata_from_filename(Path(entry.path))
                 if metadata:
                     collected.append(metadata)
 
-        elif file.suffix.lower() == ".zip":
+        elif suffix == ".zip":
+            file = Path(entry.path)
             try:
                 with zipfile.ZipFile(file, "r") as zipf:
                     for zip_info in zipf.infolist():
@@ -176,13 +238,14 @@ def collect_sensor_files(target_folder, name_patterns) -> List[FileMetadata]:
                                 Path(zip_info.filename)
                             )
                             if metadata:
-                                metadata["source_zip"] = str(file)
-                                metadata["internal_path"] = zip_info.filename
+                                metadata.source_zip = str(file)
+                                metadata.internal_path = zip_info.filename
                                 collected.append(metadata)
             except zipfile.BadZipFile:
                 tqdm.write(f"⚠️ ZIPファイルが壊れています: {file}")
                 continue
 
+    tqdm.write(f"🔍 検索対象ファイル数: {scanned}")
     return collected
 
 
@@ -216,24 +279,48 @@ def group_sensor_files(files: List[FileMetadata]) -> List[GroupedSensorFileSet]:
 def filter_unprocessed_file_sets(
     grouped_sets: List[GroupedSensorFileSet],
     events: List[EventInfo],
-    db_path: str,
+    con: duckdb.DuckDBPyConnection,
 ) -> List[GroupedSensorFileSet]:
+    files = [file for group in grouped_sets for file in group.files]
+
+    # ファイル×イベントの期間重なりを numpy のブロードキャストで一括判定
+    file_start = np.array([f.start_time for f in files], dtype="datetime64[us]")
+    file_end = np.array([f.end_time for f in files], dtype="datetime64[us]")
+    event_start = np.array([ev.start_time for ev in events], dtype="datetime64[us]")
+    event_end = np.array([ev.end_time for ev in events], dtype="datetime64[us]")
+    overlap = (event_start[None, :] <= file_end[:, None]) & (
+        file_start[:, None] < event_end[None, :]
+    )
+    file_idx, event_idx = np.nonzero(overlap)
+
+    # 重なる (ファイル, イベント) の組の処理済み判定は1クエリで行う
+    source_files = np.array([f.source_file for f in files], dtype=object)
+    event_names = np.array([ev.event for ev in events], dtype=object)
+    candidates = pd.DataFrame(
+        {
+            "source_file": source_files[file_idx],
+            "event": event_names[event_idx],
+            "event_start": event_start[event_idx],
+            "event_end": event_end[event_idx],
+        }
+    )
+    processed = fetch_processed_file_events(con, candidates)
+    is_processed = np.array(
+        [pair in processed for pair in zip(candidates["source_file"], candidates["event"])],
+        dtype=bool,
+    )
+
+    # 未処理のイベントが1つでも重なるファイルを残す
+    keep = np.zeros(len(files), dtype=bool)
+    keep[file_idx[~is_processed]] = True
+
     filtered_sets: List[GroupedSensorFileSet] = []
+    offset = 0
     for group in grouped_sets:
-        matched_files = []
-
-        for file in group.files:
-            for ev in events:
-                if ev.start_time <= file.end_time and file.start_time < ev.end_time:
-                    if not is_file_event_already_processed(
-                        db_path=db_path,
-                        source_file=file.source_file,
-                        event=ev.event,
-                        event_start=ev.start_time,
-                        event_end=ev.end_time,
-                    ):
-                        matched_files.append(file)
-                        break
+        group_keep = keep[offset : offset + len(group.files)]
+        offset += len(group.files)
+        matched_files = [f for f, k in zip(group.files, group_keep) if k]
+
         if matched_files:
             filtered_sets.append(
                 GroupedSensorFileSet(
@@ -248,25 +335,155 @@ def filter_unprocessed_file_sets(
     return filtered_sets
 
 
-def read_csv_cleaned(file: FileMetadata, encoding: str) -> pd.DataFrame:
+def read_raw_bytes(
+    file: FileMetadata,
+    zip_cache: Optional[Dict[str, zipfile.ZipFile]] = None,
+) -> bytes:
     if file.source_zip:
-        with zipfile.ZipFile(file.source_zip, "r") as zipf:
-            raw_bytes = zipf.read(file.internal_path)
-            raw_str = raw_bytes.decode(encoding)
+        # 同じZIPはセット内で開いたハンドルを使い回す（close は呼び出し側）
+        if zip_cache is None:
+            with zipfile.ZipFile(file.source_zip, "r") as zipf:
+                return zipf.read(file.internal_path)
+        zipf = zip_cache.get(file.source_zip)
+        if zipf is None:
+            zipf = zipfile.ZipFile(file.source_zip, "r")
+            zip_cache[file.source_zip] = zipf
+        return zipf.read(file.internal_path)
+
+    with open(file.source_file, "rb") as f:
+        return f.read()
+
+
+def _align_row_widths(
+    body: memoryview, width: int, encoding: str
+) -> Tuple[Optional[pa.Buffer], int]:
+    # 列数の足りない行（末尾の空欄を省いた行など）に、バイト列のままカンマを補って全行の列数をそろえる
+    # （pyarrowに行を弾かせず、行単位のPython処理を通さない。ファイルの行順もそのまま）
+    buf = np.frombuffer(body, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord("\n"))
+    if len(buf) and buf[-1] != ord("\n"):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # CRLFの\rは行の内容に含めない
+    has_cr = (ends > starts) & (buf[np.maximum(ends - 1, 0)] == ord("\r"))
+    stops = ends - has_cr
+
+    comma_pos = np.flatnonzero(buf == ord(","))
+    commas = np.searchsorted(comma_pos, stops) - np.searchsorted(comma_pos, starts)
+    # 引用符を含む行だけは、引用符内のカンマを数えないようcsvで列数を数える
+    quote_pos = np.flatnonzero(buf == ord('"'))
+    quoted = np.searchsorted(quote_pos, stops) > np.searchsorted(quote_pos, starts)
+    for i in np.flatnonzero(quoted):
+        line = bytes(buf[starts[i]:stops[i]]).decode(encoding)
+        commas[i] = len(next(csv.reader([line]))) - 1
+
+    # カンマだけの行は改行に置き換えて空行にする（空行はpyarrowが読み飛ばすため補わない）
+    lengths = stops - starts
+    blank = (lengths > 0) & (commas == lengths)
+    if blank.any():
+        blank_lengths = lengths[blank]
+        offsets = np.arange(blank_lengths.sum()) - np.repeat(
+            np.cumsum(blank_lengths) - blank_lengths, blank_lengths
+        )
+        buf = buf.copy()
+        buf[np.repeat(starts[blank], blank_lengths) + offsets] = ord("\n")
+
+    # データ行がなければNoneを返す。ヘッダーより長い行に合わせて全体の列数を決める
+    filled = (lengths > 0) & ~blank
+    if not filled.any():
+        return None, width
+    n_cols = max(width, int(commas[filled].max()) + 1)
+    pad = np.where(filled, n_cols - 1 - commas, 0)
+    if pad.any():
+        buf = np.insert(buf, np.repeat(stops, pad), ord(","))
+    return pa.py_buffer(buf), n_cols
+
+
+def read_csv_cleaned(
+    file: FileMetadata,
+    encoding: str,
+    raw_bytes: Optional[bytes] = None,
+) -> pd.DataFrame:
+    if raw_bytes is None:
+        raw_bytes = read_raw_bytes(file)
+
+    # 3行ヘッダーだけ先にデコードし、列名はpandas(header=[0, 1, 2])と同じ規則で組み立てる
+    # 行末カンマはヘッダー行からだけ除き、本体の余分な列は読込後に捨てる
+    # （shift_jis / utf-8 ではマルチバイト文字中に "," や改行は現れない）
+    header_end = 0
+    for _ in range(3):
+        header_end = raw_bytes.find(b"\n", header_end) + 1 or len(raw_bytes)
+    header_bytes = _TRAILING_COMMAS_RE.sub(b"", raw_bytes[:header_end])
+    header_lines = header_bytes.decode(encoding).splitlines()
+    header_rows = list(csv.reader(header_lines))
+    if len(header_rows) < 3 or len({len(row) for row in header_rows}) != 1:
+        raise ValueError("ヘッダー行の列数が一致しません")
+    columns = pd.MultiIndex.from_tuples(
+        [
+            tuple(
+                cell if cell else f"Unnamed: {i}_level_{level}"
+                for level, cell in enumerate(cells)
+            )
+            for i, cells in enumerate(zip(*header_rows))
+        ]
+    )
+
+    # 本体は列数をそろえてから、pyarrowのCSVリーダーで文字列のまま読む（デコードもpyarrow側で行う）
+    body, n_cols = _align_row_widths(
+        memoryview(raw_bytes)[header_end:], len(columns), encoding
+    )
+    names = [f"c{i}" for i in range(n_cols)]
+    if body is None:
+        tbl = pa.table({name: pa.array([], pa.string()) for name in names})
     else:
-        with open(file.source_file, "r", encoding=encoding) as f:
-            raw_str = f.read()
+        tbl = pacsv.read_csv(
+            pa.BufferReader(body),
+            read_options=pacsv.ReadOptions(
+                column_names=names, block_size=8 << 20, encoding=encoding
+            ),
+            convert_options=pacsv.ConvertOptions(
+                column_types={name: pa.string() for name in names},
+                strings_can_be_null=True,
+            ),
+        )
+    # ヘッダーのない末尾の列は捨てる
+    tbl = tbl.select(names[: len(columns)])
+
+    df = tbl.to_pandas(types_mapper=pd.ArrowDtype)
+    df.columns = columns
+    return df
 
-    cleaned_lines = [line.rstrip(",") for line in raw_str.splitlines()]
-    cleaned_str = "\n".join(cleaned_lines)
 
-    return pd.read_csv(io.StringIO(cleaned_str), header=[0, 1, 2], dtype=str)
+def _detect_timestamp_format(values: pd.Series) -> Optional[str]:
+    non_null = values.dropna()
+    if non_null.empty:
+        return None
+    sample = str(non_null.iloc[0])
+    for fmt in _TIMESTAMP_FORMATS:
+        try:
+            datetime.strptime(sample, fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+
+def _local_duckdb() -> duckdb.DuckDBPyConnection:
+    # spawnされたワーカーはモジュールを読み直すため、それぞれが自分の接続を持つ
+    global _LOCAL_CON
+    if _LOCAL_CON is None:
+        _LOCAL_CON = duckdb.connect()
+    return _LOCAL_CON
 
 
-def convert_csv_to_long_format(file: "FileMetadata", encoding: str) -> pd.DataFrame:
+def convert_csv_to_long_format(
+    file: "FileMetadata",
+    encoding: str,
+    raw_bytes: Optional[bytes] = None,
+) -> pd.DataFrame:
     tqdm.write(f"   ├─ 処理中: {Path(file.source_file).name} [{file.sensor_type}]")
 
-    df = read_csv_cleaned(file, encoding=encoding)
+    df = read_csv_cleaned(file, encoding=encoding, raw_bytes=raw_bytes)
     df = df.loc[:, ~df.columns.duplicated()]
 
     valid_cols = []
@@ -283,21 +500,52 @@ def convert_csv_to_long_format(file: "FileMetadata", encoding: str) -> pd.DataFr
     df.columns = ["|".join(filter(None, map(str, col))).strip() for col in df.columns]
 
     time_col = df.columns[0]
-    df_long = df.melt(id_vars=[time_col], var_name="parameter_full", value_name="value")
-
-    df_long.rename(columns={time_col: "timestamp"}, inplace=True)
-    df_long["timestamp"] = pd.to_datetime(df_long["timestamp"], errors="coerce")
+    df = df.rename(columns={time_col: "timestamp"})
+    df["timestamp"] = pd.to_datetime(
+        df["timestamp"],
+        format=_detect_timestamp_format(df["timestamp"]),
+        errors="coerce",
+        cache=True,
+    )
 
-    df_long[["parameter_id", "parameter_name", "unit"]] = df_long[
-        "parameter_full"
-    ].str.split("|", expand=True)
+    # "ID|名称|単位" の分解は行ではなく列名（パラメータ数分）に対して1回だけ行う
+    params = []
+    for name in df.columns[1:]:
+        parts = [part.strip() for part in name.split("|", 2)]
+        params.append([name] + parts + [None] * (3 - len(parts)))
+    params_df = pd.DataFrame(
+        params, columns=["parameter_full", "parameter_id", "parameter_name", "unit"]
+    )
 
-    df_long["parameter_id"] = df_long["parameter_id"].str.strip()
-    df_long["parameter_name"] = df_long["parameter_name"].str.strip()
-    df_long["unit"] = df_long["unit"].str.strip()
+    # 縦持ち変換はDuckDBのUNPIVOTで行い、分解済みのパラメータ情報を結合する
+    # 計測値はここで数値化する（数値にならない値はNULL、精度はセンサー値に十分な32bit）
+    con = _local_duckdb()
+    con.register("wide", df)
+    con.register("params", params_df)
+    try:
+        df_long = con.execute("""
+            SELECT
+                u.timestamp,
+                p.parameter_id,
+                p.parameter_name,
+                p.unit,
+                TRY_CAST(u.value AS FLOAT) AS value
+            FROM (
+                SELECT * FROM wide
+                UNPIVOT INCLUDE NULLS (
+                    value FOR parameter_full IN (COLUMNS(* EXCLUDE (timestamp)))
+                )
+            ) u
+            JOIN params p USING (parameter_full)
+        """).df()
+    finally:
+        con.unregister("wide")
+        con.unregister("params")
 
     df_long["source_file"] = file.source_file
     df_long["sensor_type"] = file.sensor_type
+    df_long["plant_code"] = file.plant_name_from_file
+    df_long["machine_no_from_file"] = file.machine_no_from_file
 
     return df_long[
         [
@@ -308,99 +556,184 @@ def convert_csv_to_long_format(file: "FileMetadata", encoding: str) -> pd.DataFr
             "value",
             "source_file",
             "sensor_type",
+            "plant_code",
+            "machine_no_from_file",
         ]
     ]
 
 
+def _run_inline(fn, *args, **kwargs) -> Future:
+    # executor未指定時用：その場で実行し、結果を完了済みのFutureで返す
+    future: Future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
 def convert_group_to_long_df(
-    group: "GroupedSensorFileSet", encoding: str
+    group: "GroupedSensorFileSet",
+    encoding: str,
+    executor: Optional[Executor] = None,
 ) -> pd.DataFrame:
     tqdm.write(f"\n📦 セット処理開始: {group.prefix}")
     tqdm.write(f"├─ ファイル数: {len(group.files)}")
 
+    # ファイルごとの変換は独立しているので、executorがあれば並列に実行する
+    # 投入済みで未回収の変換はワーカー数までにとどめ、ZIPから読んだバイト列を溜め込まない
+    submit = executor.submit if executor is not None else _run_inline
+    max_in_flight = os.cpu_count() or 1
+    pending: Deque[Tuple[int, FileMetadata, Future]] = deque()
     dfs = []
-    seen_params = set()
+    zip_cache: Dict[str, zipfile.ZipFile] = {}
 
-    for f in group.files:
+    def collect_oldest():
+        # 結果はファイル順に回収する（重複センサー除去でファイル順を使うため）
+        file_no, f, future = pending.popleft()
         try:
-            tqdm.write(
-                f"   └─ ファイル: {f.source_file} / ZIP: {f.source_zip} / internal: {f.internal_path}"
-            )
-            df = convert_csv_to_long_format(f, encoding)
-            df = df[~df["parameter_id"].isin(seen_params)]
-            seen_params.update(df["parameter_id"].unique())
+            df = future.result()
+            df["file_no"] = file_no
             dfs.append(df)
         except Exception as e:
             tqdm.write(f"⚠️ {f.source_file} の読み込みに失敗: {e}")
 
-    return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
-
-
-def register_to_duckdb(db_path: str, df: pd.DataFrame):
-    con = duckdb.connect(db_path)
+    try:
+        for file_no, f in enumerate(group.files):
+            tqdm.write(
+                f"   └─ ファイル: {f.source_file} / ZIP: {f.source_zip} / internal: {f.internal_path}"
+            )
+            try:
+                # ZIP内ファイルはここで読んだバイト列を渡し、変換側でZIPを開き直さない
+                raw_bytes = read_raw_bytes(f, zip_cache) if f.source_zip else None
+                future = submit(
+                    convert_csv_to_long_format, f, encoding, raw_bytes=raw_bytes
+                )
+                del raw_bytes
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            pending.append((file_no, f, future))
+            if len(pending) >= max_in_flight:
+                collect_oldest()
+    finally:
+        for zipf in zip_cache.values():
+            zipf.close()
+
+    while pending:
+        collect_oldest()
+
+    if not dfs:
+        return pd.DataFrame()
+
+    # 重複センサー除去：同じparameter_idは最初に読んだファイルのものだけ残す
+    df = pd.concat(dfs, ignore_index=True)
+    first_file_no = df.groupby("parameter_id", sort=False, dropna=False)[
+        "file_no"
+    ].transform("min")
+    df = df[df["file_no"] == first_file_no]
+    return df.drop(columns="file_no").reset_index(drop=True)
+
+
+def register_to_duckdb(con: duckdb.DuckDBPyConnection, df: pd.DataFrame):
+    # 抽出時にJOINせず絞り込めるよう、工場・機械番号は各行に持たせる
+    # イベントは行に持たせず、processed_file_periods の (source_file, event, 期間) で引く
     con.execute("""
         CREATE TABLE IF NOT EXISTS sensor_data (
             timestamp TIMESTAMP,
             parameter_id TEXT,
             parameter_name TEXT,
             unit TEXT,
-            value TEXT,
+            value FLOAT,
             source_file TEXT,
-            sensor_type TEXT
+            sensor_type TEXT,
+            plant_code TEXT,
+            machine_no_from_file TEXT
         )
     """)
+    # 工場・機械番号の列がない既存DB（旧スキーマ）には列を追加する
+    con.execute("ALTER TABLE sensor_data ADD COLUMN IF NOT EXISTS plant_code TEXT")
+    con.execute("ALTER TABLE sensor_data ADD COLUMN IF NOT EXISTS machine_no_from_file TEXT")
+    # 計測値を文字列で保持していた既存DBは、数値でない値をNULLにしてFLOATへ変換する
+    (value_type,) = con.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'sensor_data' AND column_name = 'value'
+    """).fetchone()
+    if value_type != "FLOAT":
+        con.execute(
+            "ALTER TABLE sensor_data ALTER COLUMN value SET DATA TYPE FLOAT USING TRY_CAST(value AS FLOAT)"
+        )
 
     con.register("temp_df", df)
+    # 重複判定は (timestamp, parameter_id, source_file) のキーだけで行う
+    # 既存行との重複はNOT EXISTSで、同じバッチ内の重複はQUALIFYで1行に絞る
+    # 時刻順に書き込み、行グループのmin/max（ゾーンマップ）で期間指定の抽出を絞り込めるようにする
     con.execute("""
-        INSERT INTO sensor_data
-        SELECT * FROM temp_df
-        EXCEPT
-        SELECT * FROM sensor_data
+        INSERT INTO sensor_data BY NAME
+        SELECT t.* FROM temp_df t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM sensor_data s
+            WHERE s.timestamp IS NOT DISTINCT FROM t.timestamp
+            AND s.parameter_id IS NOT DISTINCT FROM t.parameter_id
+            AND s.source_file IS NOT DISTINCT FROM t.source_file
+        )
+        QUALIFY row_number() OVER (
+            PARTITION BY t.timestamp, t.parameter_id, t.source_file
+        ) = 1
+        ORDER BY t.timestamp, t.parameter_id
     """)
     con.unregister("temp_df")
-    con.close()
     tqdm.write(f"✅ DuckDB登録: {len(df)} 行追加しました")
 
 
 def main(user_input):
-    # 処理済みファイル記録テーブルの初期化
-    init_processed_file_periods_table(user_input.db_path)
-
-    # 対象ファイル収集
-    all_files = collect_sensor_files(user_input.target_folder, user_input.name_patterns)
-
-    # セット化（センサータイプごと、ファイル名prefixごと）
-    grouped_sets = group_sensor_files(all_files)
-
-    # 未処理かつイベントと重なるセットのみ抽出
-    filtered_sets = filter_unprocessed_file_sets(
-        grouped_sets, user_input.events, user_input.db_path
-    )
+    # DB接続はパイプライン全体で1本を使い回す
+    con = duckdb.connect(user_input.db_path)
+    try:
+        # 処理済みファイル記録テーブルの初期化
+        init_processed_file_periods_table(con)
 
-    # セット単位で処理
-    for group in tqdm(filtered_sets, desc="📦 セット処理中"):
-        tqdm.write(f"📦 {group.prefix} を処理中")
+        # 対象ファイル収集
+        all_files = collect_sensor_files(
+            user_input.target_folder, user_input.name_patterns
+        )
 
-        df = convert_group_to_long_df(group, user_input.encoding)
+        # セット化（センサータイプごと、ファイル名prefixごと）
+        grouped_sets = group_sensor_files(all_files)
 
-        if df.empty:
-            tqdm.write(f"⚠️ 空データスキップ: {group.prefix}")
-            continue
+        # 未処理かつイベントと重なるセットのみ抽出
+        filtered_sets = filter_unprocessed_file_sets(
+            grouped_sets, user_input.events, con
+        )
 
-        register_to_duckdb(user_input.db_path, df)
-
-        # 対象イベントに対して処理済み記録
-        for ev in user_input.events:
-            if ev.start_time <= group.end and group.start < ev.end_time:
-                for f in group.files:
-                    mark_file_event_as_processed(
-                        db_path=user_input.db_path,
-                        source_file=f.source_file,
-                        source_zip=f.source_zip,
-                        event=ev.event,
-                        start_time=ev.start_time,
-                        end_time=ev.end_time,
-                    )
+        # セット単位で処理（CSVの変換はプロセスプールで並列化）
+        # DuckDB接続を開いたままforkしないよう、ワーカーはspawnで起動する
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(), mp_context=mp.get_context("spawn")
+        ) as executor:
+            for group in tqdm(filtered_sets, desc="📦 セット処理中"):
+                tqdm.write(f"📦 {group.prefix} を処理中")
+
+                df = convert_group_to_long_df(group, user_input.encoding, executor)
+
+                if df.empty:
+                    tqdm.write(f"⚠️ 空データスキップ: {group.prefix}")
+                    continue
+
+                register_to_duckdb(con, df)
+
+                # 対象イベントに対して処理済み記録（セット単位で一括INSERT）
+                mark_file_events_as_processed(
+                    con,
+                    [
+                        (f.source_file, f.source_zip, ev.event, ev.start_time, ev.end_time)
+                        for ev in user_input.events
+                        if ev.start_time <= group.end and group.start < ev.end_time
+                        for f in group.files
+                    ],
+                )
+    finally:
+        con.close()
 
 
 if __name__ == "__main__":
@@ -1,18 +1,28 @@
+import multiprocessing as mp
+import os
 import pytest
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import duckdb
 import pandas as pd
+import pyarrow as pa
 from pathlib import Path
 from main import (
     collect_sensor_files,
     group_sensor_files,
     filter_unprocessed_file_sets,
+    fetch_processed_file_events,
     convert_group_to_long_df,
     register_to_duckdb,
     mark_file_event_as_processed,
+    mark_file_events_as_processed,
+    init_processed_file_periods_table,
+    read_csv_cleaned,
     FileMetadata,
+    GroupedSensorFileSet,
     EventInfo
 )
+from extract import extract_sensor_data
 
 TEST_FOLDER = Path("./test_data")
 TEST_DB = "test_sensor_data.duckdb"
@@ -39,9 +49,11 @@ def setup_db():
             parameter_id TEXT,
             parameter_name TEXT,
             unit TEXT,
-            value TEXT,
+            value FLOAT,
             source_file TEXT,
-            sensor_type TEXT
+            sensor_type TEXT,
+            plant_code TEXT,
+            machine_no_from_file TEXT
         )
     """)
     yield con
@@ -78,9 +90,112 @@ def test_filter_unprocessed_file_sets(setup_db):
 
     groups = group_sensor_files(collect_sensor_files(DummyInput.target_folder, DummyInput.name_patterns))
     dummy_events = [EventInfo(event= "TEST", start_time= datetime(2020,1,1, 0,0,0), end_time=datetime(2030,1,1, 0,0,0))]
-    filtered = filter_unprocessed_file_sets(groups, dummy_events, TEST_DB)
+    filtered = filter_unprocessed_file_sets(groups, dummy_events, setup_db)
     assert isinstance(filtered, list)
 
+# --- 期間重なり・処理済み判定テスト（複数セット） ---
+def test_filter_unprocessed_file_sets_in_memory():
+    con = duckdb.connect()
+    init_processed_file_periods_table(con)
+
+    def file(name, start_hour, start_minute, end_hour, end_minute):
+        return FileMetadata(
+            plant_name_from_file="P1",
+            machine_no_from_file="M01",
+            sensor_type="Tmp",
+            start_time=datetime(2020,1,1, start_hour,start_minute,0),
+            end_time=datetime(2020,1,1, end_hour,end_minute,0),
+            source_file=name,
+        )
+
+    files = [
+        file("G1_none.csv", 5,0, 6,0),     # どのイベントとも重ならない
+        file("G1_done.csv", 0,10, 0,50),   # 重なるAが処理済み
+        file("G1_half.csv", 0,30, 2,30),   # Aは処理済み、Bは未処理
+        file("G2_new.csv", 0,10, 0,20),    # Aが未処理
+        file("G2_done.csv", 2,10, 2,20),   # 重なるBが処理済み
+        file("G3_none.csv", 10,0, 11,0),   # セットごと除外される
+    ]
+    events = [
+        EventInfo(event="A", description="", start_time=datetime(2020,1,1, 0,0,0), end_time=datetime(2020,1,1, 1,0,0)),
+        EventInfo(event="B", description="", start_time=datetime(2020,1,1, 2,0,0), end_time=datetime(2020,1,1, 3,0,0)),
+    ]
+    mark_file_events_as_processed(
+        con,
+        [
+            ("G1_done.csv", None, "A", datetime(2020,1,1, 0,0,0), datetime(2020,1,1, 1,0,0)),
+            ("G1_half.csv", None, "A", datetime(2020,1,1, 0,0,0), datetime(2020,1,1, 1,0,0)),
+            ("G2_done.csv", None, "B", datetime(2020,1,1, 2,0,0), datetime(2020,1,1, 3,0,0)),
+        ],
+    )
+
+    filtered = filter_unprocessed_file_sets(group_sensor_files(files), events, con)
+    con.close()
+    assert [(g.prefix, [f.source_file for f in g.files]) for g in filtered] == [
+        ("G1", ["G1_half.csv"]),
+        ("G2", ["G2_new.csv"]),
+    ]
+
+# --- 処理済み (source_file, event) 一括取得テスト ---
+def test_fetch_processed_file_events(setup_db):
+    setup_db.execute("""
+        INSERT OR REPLACE INTO processed_file_periods VALUES
+        ('done.csv', NULL, 'TEST', '2020-01-01 00:00:00', '2030-01-01 00:00:00')
+    """)
+    candidates = pd.DataFrame(
+        [
+            ("done.csv", "TEST", datetime(2021,1,1, 0,0,0), datetime(2022,1,1, 0,0,0)),
+            ("done.csv", "OTHER", datetime(2021,1,1, 0,0,0), datetime(2022,1,1, 0,0,0)),
+            ("todo.csv", "TEST", datetime(2021,1,1, 0,0,0), datetime(2022,1,1, 0,0,0)),
+        ],
+        columns=["source_file", "event", "event_start", "event_end"],
+    )
+    processed = fetch_processed_file_events(setup_db, candidates)
+    assert processed == {("done.csv", "TEST")}
+
+# --- CSV読込テスト ---
+def test_read_csv_cleaned(tmp_path):
+    # shift_jis・CRLF・行末カンマ・空欄ヘッダー・末尾が欠けた行を含むCSV
+    csv_path = tmp_path / "P1_M01_CSV_20200101000000.csv"
+    csv_path.write_bytes(
+        (
+            "日時,温度,圧力,,\r\n"
+            ",T001,P001,\r\n"
+            "単位,℃,kPa,,,\r\n"
+            "2020/01/01 00:00:00,1.5,2.5,,\r\n"
+            "2020/01/01 00:00:01,1.6,,\r\n"
+            "2020/01/01 00:00:02,,2.7\r\n"
+        ).encode("shift_jis")
+    )
+    file = FileMetadata(
+        plant_name_from_file="P1",
+        machine_no_from_file="M01",
+        sensor_type="CSV",
+        start_time=datetime(2020,1,1, 0,0,0),
+        end_time=datetime(2020,1,1, 0,0,2),
+        source_file=str(csv_path),
+    )
+
+    df = read_csv_cleaned(file, "shift_jis")
+
+    # 列数の不足した行はNULL埋めされ、行順はファイルのまま
+    expected = pd.DataFrame(
+        [
+            ["2020/01/01 00:00:00", "1.5", "2.5"],
+            ["2020/01/01 00:00:01", "1.6", None],
+            ["2020/01/01 00:00:02", None, "2.7"],
+        ],
+        columns=pd.MultiIndex.from_tuples(
+            [
+                ("日時", "Unnamed: 0_level_1", "単位"),
+                ("温度", "T001", "℃"),
+                ("圧力", "P001", "kPa"),
+            ]
+        ),
+        dtype=pd.ArrowDtype(pa.string()),
+    )
+    pd.testing.assert_frame_equal(df, expected)
+
 # --- データ整形処理テスト ---
 def test_convert_group_to_long_df():
     class DummyInput:
@@ -93,6 +208,57 @@ def test_convert_group_to_long_df():
     assert "timestamp" in df.columns
     assert "parameter_id" in df.columns
 
+# --- 重複センサー除去・読込失敗ファイルのテスト（直接実行・プロセスプール） ---
+@pytest.mark.parametrize("use_executor", [False, True])
+def test_convert_group_to_long_df_keeps_first_file(tmp_path, monkeypatch, use_executor):
+    start, end = datetime(2020,1,1, 0,0,0), datetime(2020,1,1, 0,0,1)
+    contents = {
+        "first.csv": "日時,P001,P002\n,温度,圧力\n,℃,kPa\n2020/01/01 00:00:00,1,2\n2020/01/01 00:00:01,3,4\n",
+        # ヘッダー行の列数が不一致で変換に失敗するファイル
+        "broken.csv": "日時,P001\n,温度,圧力\n",
+        "second.csv": "日時,P002,P003\n,圧力,流量\n,kPa,L\n2020/01/01 00:00:00,20,30\n2020/01/01 00:00:01,40,50\n",
+    }
+    files = []
+    for name, content in contents.items():
+        path = tmp_path / name
+        path.write_text(content, encoding=ENCODING)
+        files.append(
+            FileMetadata(
+                plant_name_from_file="P1",
+                machine_no_from_file="M01",
+                sensor_type="Tmp",
+                start_time=start,
+                end_time=end,
+                source_file=str(path),
+            )
+        )
+    group = GroupedSensorFileSet(
+        prefix="P1_M01", plant_name_from_file="P1", machine_no_from_file="M01",
+        start=start, end=end, files=files,
+    )
+
+    if use_executor:
+        # 未回収の投入数を1に絞り、回収を待ちながら投入する経路も通す
+        monkeypatch.setattr(os, "cpu_count", lambda: 1)
+        with ProcessPoolExecutor(max_workers=2, mp_context=mp.get_context("spawn")) as executor:
+            df = convert_group_to_long_df(group, ENCODING, executor)
+    else:
+        df = convert_group_to_long_df(group, ENCODING)
+
+    # P002 は最初のファイルの行だけが残り、失敗したファイルはセット全体を止めない
+    result = sorted(
+        (row.parameter_id, Path(row.source_file).name, row.value)
+        for row in df.itertuples()
+    )
+    assert result == [
+        ("P001", "first.csv", 1.0),
+        ("P001", "first.csv", 3.0),
+        ("P002", "first.csv", 2.0),
+        ("P002", "first.csv", 4.0),
+        ("P003", "second.csv", 30.0),
+        ("P003", "second.csv", 50.0),
+    ]
+
 # --- DuckDB登録テスト ---
 def test_register_to_duckdb(setup_db):
     class DummyInput:
@@ -101,14 +267,135 @@ def test_register_to_duckdb(setup_db):
 
     groups = group_sensor_files(collect_sensor_files(DummyInput.target_folder, DummyInput.name_patterns))
     df = convert_group_to_long_df(groups[0], ENCODING)
-    register_to_duckdb(TEST_DB, df)
-    con = duckdb.connect(TEST_DB)
-    result = con.sql("SELECT COUNT(*) FROM sensor_data").fetchone()
+    register_to_duckdb(setup_db, df)
+    result = setup_db.sql("SELECT COUNT(*) FROM sensor_data").fetchone()
     assert result[0] > 0
 
+# --- バッチ内重複の登録テスト ---
+def test_register_to_duckdb_dedupes_batch(setup_db):
+    row = {
+        "timestamp": datetime(2020,1,1, 0,0,0),
+        "parameter_id": "T001",
+        "parameter_name": "温度",
+        "unit": "℃",
+        "value": 1.5,
+        "source_file": "dup.csv",
+        "sensor_type": "Tmp",
+        "plant_code": "DUP",
+        "machine_no_from_file": "No.1",
+    }
+    # 同じCSV行が2回含まれるバッチ
+    df = pd.DataFrame([row, row, {**row, "timestamp": datetime(2020,1,1, 0,0,1)}])
+    register_to_duckdb(setup_db, df)
+    register_to_duckdb(setup_db, df)
+    result = setup_db.sql("SELECT COUNT(*) FROM sensor_data WHERE source_file = 'dup.csv'").fetchone()
+    assert result[0] == 2
+
+# --- 旧スキーマDBへの登録テスト ---
+def test_register_to_duckdb_migrates_old_schema(tmp_path):
+    con = duckdb.connect(str(tmp_path / "old.duckdb"))
+    con.execute("""
+        CREATE TABLE sensor_data (
+            timestamp TIMESTAMP,
+            parameter_id TEXT,
+            parameter_name TEXT,
+            unit TEXT,
+            value TEXT,
+            source_file TEXT,
+            sensor_type TEXT
+        )
+    """)
+    con.execute("""
+        INSERT INTO sensor_data VALUES
+        ('2020-01-01 00:00:00', 'T001', '温度', '℃', '1.5', 'old.csv', 'Tmp'),
+        ('2020-01-01 00:00:01', 'T001', '温度', '℃', '-', 'old.csv', 'Tmp')
+    """)
+    df = pd.DataFrame(
+        {
+            "timestamp": [datetime(2020,1,1, 0,0,0)],
+            "parameter_id": "T001",
+            "parameter_name": "温度",
+            "unit": "℃",
+            "value": [2.5],
+            "source_file": "new.csv",
+            "sensor_type": "Tmp",
+            "plant_code": "P1",
+            "machine_no_from_file": "No.1",
+        }
+    )
+    register_to_duckdb(con, df)
+    result = con.sql("SELECT source_file, value, plant_code, machine_no_from_file FROM sensor_data ORDER BY source_file, timestamp").fetchall()
+    value_type = con.sql("SELECT typeof(value) FROM sensor_data LIMIT 1").fetchone()
+    con.close()
+    assert value_type == ("FLOAT",)
+    assert result == [
+        ("new.csv", 2.5, "P1", "No.1"),
+        ("old.csv", 1.5, None, None),
+        ("old.csv", None, None, None),
+    ]
+
+# --- イベント指定抽出テスト ---
+def test_extract_sensor_data_by_event(setup_db):
+    df = pd.DataFrame(
+        {
+            "timestamp": [datetime(2020,1,1, h,0,0) for h in range(4)],
+            "parameter_id": "T001",
+            "parameter_name": "温度",
+            "unit": "℃",
+            "value": [0.0, 1.0, 2.0, 3.0],
+            "source_file": "event.csv",
+            "sensor_type": "Tmp",
+            "plant_code": "EV",
+            "machine_no_from_file": "No.1",
+        }
+    )
+    register_to_duckdb(setup_db, df)
+    mark_file_events_as_processed(
+        setup_db, [("event.csv", None, "A", datetime(2020,1,1, 0,30,0), datetime(2020,1,1, 2,30,0))]
+    )
+
+    # 後の実行で、登録済みの行と重なるイベントBを追加する（新しい行は増えない）
+    register_to_duckdb(setup_db, df)
+    mark_file_events_as_processed(
+        setup_db, [("event.csv", None, "B", datetime(2020,1,1, 1,30,0), datetime(2020,1,1, 3,30,0))]
+    )
+
+    def hours(event=None):
+        result = extract_sensor_data(setup_db, "EV", "No.1", event=event)
+        return sorted(ts.hour for ts in result["timestamp"])
+
+    # どのイベント期間にも含まれない 0時 の行は、イベント指定時には返らない
+    assert hours("A") == [1, 2]
+    assert hours("B") == [2, 3]
+    assert hours() == [0, 1, 2, 3]
+
 # --- 処理済みマークテスト ---
 def test_mark_file_event_as_processed(setup_db):
-    mark_file_event_as_processed(TEST_DB, "dummy.csv", EventInfo(event= "TEST", start_time= datetime(2020,1,1, 0,0,0), end_time=datetime(2030,1,1, 0,0,0)),)
-    con = duckdb.connect(TEST_DB)
-    result = con.sql("SELECT COUNT(*) FROM processed_file_periods WHERE source_file='dummy.csv'").fetchone()
+    mark_file_event_as_processed(setup_db, "dummy.csv", EventInfo(event= "TEST", start_time= datetime(2020,1,1, 0,0,0), end_time=datetime(2030,1,1, 0,0,0)),)
+    result = setup_db.sql("SELECT COUNT(*) FROM processed_file_periods WHERE source_file='dummy.csv'").fetchone()
     assert result[0] > 0
+
+# --- 処理済みマーク一括登録テスト ---
+def test_mark_file_events_as_processed(setup_db):
+    start, end = datetime(2020,1,1, 0,0,0), datetime(2030,1,1, 0,0,0)
+    mark_file_events_as_processed(
+        setup_db,
+        [
+            ("dummy_a.csv", None, "TEST", start, end),
+            ("dummy_b.csv", "dummy.zip", "TEST", start, end),
+        ],
+    )
+    result = setup_db.sql("SELECT COUNT(*) FROM processed_file_periods WHERE source_file IN ('dummy_a.csv', 'dummy_b.csv')").fetchone()
+    assert result[0] == 2
+
+    # 同一キーが複数含まれる場合は終了時刻の遅い行が残る
+    later = datetime(2031,1,1, 0,0,0)
+    mark_file_events_as_processed(
+        setup_db,
+        [
+            ("dummy_c.csv", None, "TEST", start, later),
+            ("dummy_c.csv", None, "TEST", start, end),
+        ],
+    )
+    result = setup_db.sql("SELECT end_time FROM processed_file_periods WHERE source_file = 'dummy_c.csv'").fetchall()
+    assert result == [(later,)]